@@ -1,16 +1,17 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-from snowflake.sqlalchemy import URL
-from sqlalchemy import create_engine
-import json
+import re
+import hashlib
+import logging
+import pyarrow as pa
 from dotenv import load_dotenv
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Snowflake connection parameters
 snowflake_params = {
     "account": os.getenv('SNOWFLAKE_ACCOUNT'),
@@ -21,9 +22,63 @@ snowflake_params = {
     "schema": os.getenv('SNOWFLAKE_SCHEMA')
 }
 
+# Local DuckDB file that keeps city statistics across restarts and redeploys
+DUCKDB_PATH = os.getenv('DUCKDB_PATH', 'analytics.duckdb')
+# Stored ranges are refetched after this long
+LOCAL_CACHE_TTL = timedelta(days=7)
+# Events can arrive late, so ranges ending within this window are not stored
+LATE_ARRIVAL_WINDOW = timedelta(days=3)
+# Bump when the daily stats table is redefined; stored rows from other
+# versions (or from a different CITY_STATS_QUERY) are ignored
+LOCAL_CACHE_SCHEMA_VERSION = 1
+
+# Fixed statements, defined once and bound per call
+CITY_STATS_QUERY = """
+    SELECT
+        geo_city as city,
+        HLL_ESTIMATE(HLL_COMBINE(users_sketch)) AS number_of_users,
+        SUM(purchases) AS number_of_purchases
+    FROM
+        CANDIVORE_TEST_DB.ATOMIC.CITY_DAILY_STATS
+    WHERE
+        event_date BETWEEN TO_DATE(?) AND TO_DATE(?)
+    GROUP BY
+        geo_city
+    ORDER BY
+        number_of_users DESC
+    LIMIT 10;
+"""
+
+# Number of purchase events inspected when discovering the payload's fields
+PURCHASE_FIELD_SAMPLE_ROWS = 1000
+
+PURCHASE_FIELDS_QUERY = f"""
+    SELECT
+        k.key AS field,
+        BOOLAND_AGG(TYPEOF(k.value) IN ('INTEGER', 'DECIMAL', 'DOUBLE', 'NULL_VALUE')) AS is_number
+    FROM (
+        SELECT purchase_data
+        FROM CANDIVORE_TEST_DB.ATOMIC.USER_PURCHASES
+        LIMIT {PURCHASE_FIELD_SAMPLE_ROWS}
+    ),
+        LATERAL FLATTEN(input => purchase_data) k
+    GROUP BY
+        k.key
+    ORDER BY
+        k.key
+"""
+
 @st.cache_resource
 def init_connection():
+    # Imported here so the SQLAlchemy stack only loads when a connection is made
+    from snowflake.sqlalchemy import URL
+    from sqlalchemy import create_engine
+
     try:
+        # Connections are only used for reads, so skip the ROLLBACK round trip
+        # SQLAlchemy issues each time one is returned to the pool. qmark makes
+        # the connector bind values server-side, so the SQL text Snowflake
+        # compiles stays the same whatever the parameters are.
         engine = create_engine(URL(
             account = snowflake_params['account'],
             user = snowflake_params['user'],
@@ -31,178 +86,337 @@ def init_connection():
             database = snowflake_params['database'],
             schema = snowflake_params['schema'],
             warehouse = snowflake_params['warehouse']
-        ))
+        ), pool_reset_on_return=None, connect_args={'paramstyle': 'qmark'})
         return engine
     except Exception as e:
         st.error(f"Error connecting to Snowflake: {str(e)}")
         return None
 
-def load_data(engine, start_date, end_date):
-    query = f"""
-        
-            SELECT
-                GEO_CITY as city,
-                COUNT(DISTINCT(CONTEXTS_IO_CANDIVORE_USER_BASE_STATS_1:uuid::string)) AS number_of_users,
-                SUM(CASE WHEN EVENT_NAME = 'in_app_purchase' THEN 1 ELSE 0 END) AS number_of_purchases
-            FROM
-                CANDIVORE_TEST_DB.ATOMIC.EVENTS
-            WHERE
-                derived_tstamp BETWEEN '{start_date}' AND '{end_date}'
-                AND CONTEXTS_IO_CANDIVORE_USER_BASE_STATS_1 IS NOT NULL
-            GROUP BY
-                GEO_CITY
-            ORDER BY
-                number_of_users DESC
-            LIMIT 10;
-         
+def run_query(query, params=None):
+    # Read through the Snowflake cursor's Arrow fetch rather than pd.read_sql,
+    # which boxes every row into Python objects before building the frame
+    connection = init_connection().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            df = cursor.fetch_pandas_all()
+    finally:
+        connection.close()
+    # Snowflake returns unquoted identifiers upper-cased
+    df.columns = df.columns.str.lower()
+    return df
+
+def run_arrow_queries(queries, params=None):
+    # Submit every statement before collecting any of them so Snowflake runs
+    # them side by side; the round trip is the slowest query, not the sum
+    connection = init_connection().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            query_ids = []
+            for query in queries:
+                cursor.execute_async(query, params)
+                query_ids.append(cursor.sfqid)
+
+            tables = []
+            for query_id in query_ids:
+                cursor.get_results_from_sfqid(query_id)
+                tables.append(cursor.fetch_arrow_all())
+    finally:
+        connection.close()
+    # fetch_arrow_all returns None rather than an empty table for no rows
+    return [
+        pa.table({}) if table is None
+        else table.rename_columns([name.lower() for name in table.column_names])
+        for table in tables
+    ]
+
+def local_cache_version():
+    query_hash = hashlib.sha1(CITY_STATS_QUERY.encode()).hexdigest()[:12]
+    return f"{LOCAL_CACHE_SCHEMA_VERSION}:{query_hash}"
+
+def connect_local_cache():
+    # Imported here to keep DuckDB off the startup path
+    import duckdb
+
+    connection = duckdb.connect(DUCKDB_PATH)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS city_stats_cache (
+            cache_version VARCHAR,
+            start_date VARCHAR,
+            end_date VARCHAR,
+            fetched_at TIMESTAMP,
+            city VARCHAR,
+            number_of_users BIGINT,
+            number_of_purchases BIGINT
+        )
+    """)
+    return connection
+
+def read_local_city_stats(start_date, end_date):
+    with connect_local_cache() as connection:
+        data = connection.execute("""
+            SELECT city, number_of_users, number_of_purchases
+            FROM city_stats_cache
+            WHERE cache_version = ? AND start_date = ? AND end_date = ? AND fetched_at >= ?
+            ORDER BY number_of_users DESC
+        """, [local_cache_version(), start_date, end_date, datetime.now() - LOCAL_CACHE_TTL]).df()
+    return None if data.empty else data
+
+def write_local_city_stats(start_date, end_date, data):
+    version = local_cache_version()
+    with connect_local_cache() as connection:
+        connection.register('city_stats_df', data)
+        connection.execute("BEGIN TRANSACTION")
+        # Drop this range along with anything expired or from another version
+        connection.execute("""
+            DELETE FROM city_stats_cache
+            WHERE (start_date = ? AND end_date = ?) OR cache_version <> ? OR fetched_at < ?
+        """, [start_date, end_date, version, datetime.now() - LOCAL_CACHE_TTL])
+        connection.execute("""
+            INSERT INTO city_stats_cache
+            SELECT ?, ?, ?, ?, city, number_of_users, number_of_purchases FROM city_stats_df
+        """, [version, start_date, end_date, datetime.now()])
+        connection.execute("COMMIT")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_data(start_date, end_date):
+    # Only ranges old enough that late events are no longer expected go
+    # through the local cache, for reads as well as writes
+    if end_date >= (date.today() - LATE_ARRIVAL_WINDOW).isoformat():
+        return run_query(CITY_STATS_QUERY, [start_date, end_date])
+
+    # The local cache is best effort; fall back to Snowflake if DuckDB is
+    # unavailable or the file is locked by another worker
+    try:
+        import duckdb
+    except ImportError as e:
+        logger.warning("Local city stats cache disabled: %s", e)
+        return run_query(CITY_STATS_QUERY, [start_date, end_date])
+
+    try:
+        data = read_local_city_stats(start_date, end_date)
+        if data is not None:
+            return data
+    except duckdb.Error as e:
+        logger.warning("Could not read local city stats: %s", e)
+
+    data = run_query(CITY_STATS_QUERY, [start_date, end_date])
+    try:
+        write_local_city_stats(start_date, end_date, data)
+    except duckdb.Error as e:
+        logger.warning("Could not write local city stats: %s", e)
+    return data
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_purchase_fields():
+    # The purchase event is semi-structured, so discover its keys and value
+    # types once from a sample of events and let Snowflake project them as columns
+    fields = run_query(PURCHASE_FIELDS_QUERY)
+    return [
+        (field, is_number)
+        for field, is_number in fields[['field', 'is_number']].itertuples(index=False)
+        if re.fullmatch(r'\w+', field) and field.lower() not in ('purchase_date', 'user_name', 'daily_purchase_amount')
+    ]
+
+def purchase_field_column(field, is_number):
+    # TRY_ conversions turn a value that doesn't match the sampled type into
+    # NULL instead of failing the whole query
+    value = f'purchase_data:"{field}"'
+    # Numbers are always read as doubles: a sample of whole values says nothing
+    # about later ones, and an integer conversion would round e.g. 4.99 to 5
+    if is_number:
+        expression = f'TRY_TO_DOUBLE(TO_JSON({value}))'
+    else:
+        # An explicit JSON null would otherwise come through TO_JSON as 'null'
+        expression = f'IFF(IS_NULL_VALUE({value}), NULL, COALESCE(AS_VARCHAR({value}), TO_JSON({value})))'
+    return f'{expression} AS "{field}"'
+
+def is_price_column(column):
+    return any(term in column.lower() for term in ['price', 'amount'])
+
+@st.cache_data(ttl=600, show_spinner=False)
+def load_user_purchases(user_id):
+    purchase_columns = ''.join(
+        f',\n        {purchase_field_column(*field)}'
+        for field in load_purchase_fields()
+    )
+    # USER_PURCHASES is clustered on user_uuid, so this prunes to the user's rows
+    purchase_filter = """
+    FROM CANDIVORE_TEST_DB.ATOMIC.USER_PURCHASES
+    WHERE user_uuid = ?
+    """
+    # Totals and detail rows are separate statements so neither has to group
+    # by the purchase VARIANT itself
+    daily_query = f"""
+    SELECT 
+        DATE(derived_tstamp) as purchase_date,
+        SUM(purchase_data:iap_price::float) as daily_purchase_amount
+    {purchase_filter}
+    GROUP BY 
+        DATE(derived_tstamp)
+    ORDER BY 
+        purchase_date
     """
-    return pd.read_sql(query, engine)
+    details_query = f"""
+    SELECT 
+        DATE(derived_tstamp) as purchase_date,
+        user_name{purchase_columns}
+    {purchase_filter}
+    ORDER BY 
+        purchase_date
+    """
+    daily_purchases, purchase_details = run_arrow_queries([daily_query, details_query], [user_id])
+    daily_purchases = daily_purchases.to_pandas()
 
-def main():
-    st.title("Match Masters Analysis")
+    # Keep the details as Arrow; st.dataframe takes it without a pandas round trip
+    if not purchase_details.num_rows:
+        return daily_purchases, purchase_details
 
-    tab1, tab2 = st.tabs(["General Statistics", "Events"])
+    date_index = purchase_details.column_names.index('purchase_date')
+    return daily_purchases, purchase_details.set_column(
+        date_index, 'purchase_date', purchase_details.column('purchase_date').cast(pa.string())
+    )
 
-    # Snowflake connection
-    engine = init_connection()
+# Axis labels shared by every figure
+LABELS_CITY = {'number_of_users': 'Number of Users', 'number_of_purchases': 'Number of Purchases', 'city' : 'City'}
+LABELS_PURCHASES = {'purchase_date': 'Date', 'daily_purchase_amount': 'Purchase Amount ($)'}
 
-    # General Statistics tab
-    with tab1:
-        st.header("General Statistics")
-        col1, col2 = st.columns(2)
-        with col1:
-            start_date = st.date_input("Start Date", datetime.now() - timedelta(days=7))
-        with col2:
-            end_date = st.date_input("End Date", datetime.now())
-
-        if st.button("Run"):
-            data = load_data(engine, start_date, end_date)
-            
-            if not data.empty:
-                # Distribution of users and purchases by city
-                st.subheader("Distribution of Users and Purchases by City")
-                fig = px.scatter(data, x='number_of_users', y='number_of_purchases', hover_data=['city'],
-                                 labels={'number_of_users': 'Number of Users', 'number_of_purchases': 'Number of Purchases', 'city' : 'City'},
-                                 title="Users vs Purchases by City")
-                st.plotly_chart(fig)
-
-                # Top 10 cities by number of users
-                st.subheader("Top 10 Cities by Number of Users")
-                top_10_cities = data.nlargest(10, 'number_of_users')
-                fig = px.bar(top_10_cities, x='city', y='number_of_users',
-                             labels={'number_of_users': 'Number of Users', 'city' : 'City'},
-                             title="Top 10 Cities by Number of Users")
-                st.plotly_chart(fig)
-
-                # Correlation matrix
-                st.subheader("Correlation Matrix")
-                corr_matrix = data[['number_of_users', 'number_of_purchases']].corr()
-                fig = px.imshow(corr_matrix, 
-                                x=['Number of Users', 'Number of Purchases'], 
-                                y=['Number of Users', 'Number of Purchases'], 
-                                color_continuous_scale="RdBu_r", 
-                                title="Correlation Matrix")
-                fig.update_layout(width=500, height=500)
-                st.plotly_chart(fig)
-
-                # Display correlation
-                correlation = data['number_of_users'].corr(data['number_of_purchases'])
-                st.metric("Correlation between Number of Users and Total Purchases", f"{correlation:.2f}")
+def plotly_express():
+    # Plotly is imported lazily since it is heavy and only needed once there is
+    # data to chart
+    import plotly.express as px
+    return px
 
-            else:
-                st.write("No data available for the selected date range.")
+# Figures are cached on their inputs, so a rerun over the same data reuses
+# the built figure instead of constructing it again. Each expires with the
+# loader that feeds it and keeps a bounded number of entries.
+@st.cache_data(ttl=3600, max_entries=50, show_spinner=False)
+def scatter_users_vs_purchases(data):
+    px = plotly_express()
+    return px.scatter(data, x='number_of_users', y='number_of_purchases', hover_data=['city'],
+                      labels=LABELS_CITY, title="Users vs Purchases by City")
 
-    # Events tab
-    with tab2:
-        st.header("Events")
-        
-        user_id = st.text_input("Enter User ID")
+@st.cache_data(ttl=3600, max_entries=50, show_spinner=False)
+def bar_top_cities(data):
+    px = plotly_express()
+    return px.bar(data, x='city', y='number_of_users',
+                  labels=LABELS_CITY, title="Top 10 Cities by Number of Users")
+
+@st.cache_data(ttl=3600, max_entries=50, show_spinner=False)
+def imshow_correlation(correlation):
+    px = plotly_express()
+    corr_matrix = pd.DataFrame([[1, correlation], [correlation, 1]])
+    fig = px.imshow(corr_matrix, 
+                    x=['Number of Users', 'Number of Purchases'], 
+                    y=['Number of Users', 'Number of Purchases'], 
+                    color_continuous_scale="RdBu_r", 
+                    title="Correlation Matrix")
+    fig.update_layout(width=500, height=500)
+    return fig
+
+@st.cache_data(ttl=600, max_entries=100, show_spinner=False)
+def bar_daily_purchases(daily_purchases, user_name):
+    px = plotly_express()
+    return px.bar(
+        daily_purchases,
+        x='purchase_date',
+        y='daily_purchase_amount',
+        title=f"Daily Purchase Amounts for {user_name}",
+        labels=LABELS_PURCHASES
+    )
+
+@st.fragment
+def render_stats_tab():
+    st.header("General Statistics")
+    col1, col2 = st.columns(2)
+    with col1:
+        start_date = st.date_input("Start Date", datetime.now() - timedelta(days=7))
+    with col2:
+        end_date = st.date_input("End Date", datetime.now())
+
+    if st.button("Run"):
+        data = load_data(start_date.isoformat(), end_date.isoformat())
         
-        if user_id:  
-            try:
-                query = f"""
-                SELECT 
-                    DATE(derived_tstamp) as purchase_date,
-                    f.value:user_name::string AS user_name,
-                    UNSTRUCT_EVENT_IO_CANDIVORE_IN_APP_PURCHASE_1 as purchase_data,
-                    SUM(UNSTRUCT_EVENT_IO_CANDIVORE_IN_APP_PURCHASE_1:iap_price::float) as daily_purchase_amount
-                FROM CANDIVORE_TEST_DB.ATOMIC.EVENTS,
-                    LATERAL FLATTEN(input => CONTEXTS_IO_CANDIVORE_USER_BASE_STATS_1) f
-                WHERE f.value:uuid::string = '{user_id}'
-                    AND EVENT_NAME = 'in_app_purchase'
-                    AND UNSTRUCT_EVENT_IO_CANDIVORE_IN_APP_PURCHASE_1 IS NOT NULL
-                GROUP BY 
-                    DATE(derived_tstamp),
-                    f.value:user_name::string,
-                    UNSTRUCT_EVENT_IO_CANDIVORE_IN_APP_PURCHASE_1
-                ORDER BY 
-                    purchase_date
-                """
+        if not data.empty:
+            # Distribution of users and purchases by city
+            st.subheader("Distribution of Users and Purchases by City")
+            st.plotly_chart(scatter_users_vs_purchases(data))
+
+            # Top 10 cities by number of users
+            st.subheader("Top 10 Cities by Number of Users")
+            # load_data already returns the top 10, ordered by users
+            st.plotly_chart(bar_top_cities(data))
+
+            # Correlation matrix
+            st.subheader("Correlation Matrix")
+            correlation = data['number_of_users'].corr(data['number_of_purchases'])
+            st.plotly_chart(imshow_correlation(correlation))
+
+            # Display correlation
+            st.metric("Correlation between Number of Users and Total Purchases", f"{correlation:.2f}")
+
+        else:
+            st.write("No data available for the selected date range.")
+
+@st.fragment
+def render_events_tab():
+    st.header("Events")
+    
+    user_id = st.text_input("Enter User ID")
+    
+    if user_id:  
+        try:
+            daily_purchases, purchase_details = load_user_purchases(user_id)
+            
+            if purchase_details.num_rows:
+                user_name = purchase_details.column('user_name')[0].as_py()
+                st.subheader(f"Purchase Data for User: {user_name}")
                 
-                # Load the data
-                results = pd.read_sql(query, engine)
+                # Display summary chart
+                st.plotly_chart(bar_daily_purchases(daily_purchases, user_name))
                 
-                if not results.empty:
-                    user_name = results['user_name'].iloc[0]
-                    st.subheader(f"Purchase Data for User: {user_name}")
-                    
-                    # Display summary chart
-                    fig = px.bar(
-                        results,
-                        x='purchase_date',
-                        y='daily_purchase_amount',
-                        title=f"Daily Purchase Amounts for {user_name}",
-                        labels={
-                            'purchase_date': 'Date',
-                            'daily_purchase_amount': 'Purchase Amount ($)'
-                        }
-                    )
-                    st.plotly_chart(fig)
-                    
-                    # Process purchase data
-                    results['purchase_details'] = results['purchase_data'].apply(lambda x: json.loads(x) if x else {})
-                    
-                    # Create DataFrame from JSON data
-                    purchase_details_df = pd.DataFrame(results['purchase_details'].tolist())
-                    
-                    # Add date and user information
-                    purchase_details_df['purchase_date'] = results['purchase_date']
-                    purchase_details_df['user_name'] = results['user_name']
-                    
-                    # Move date and user_name to front
-                    cols = ['purchase_date', 'user_name'] + [col for col in purchase_details_df.columns if col not in ['purchase_date', 'user_name']]
-                    purchase_details_df = purchase_details_df[cols]
-                    
-                    # Format date
-                    purchase_details_df['purchase_date'] = pd.to_datetime(purchase_details_df['purchase_date']).dt.strftime('%Y-%m-%d')
-                    
-                    # Create dynamic column config
-                    column_config = {
-                        "purchase_date": "Date",
-                        "user_name": "User Name"
-                    }
-                    
-                    # Automatically add number formatting for price-related columns
-                    price_columns = [col for col in purchase_details_df.columns if any(term in col.lower() for term in ['price', 'amount'])]
-                    for col in price_columns:
-                        column_config[col] = st.column_config.NumberColumn(
-                            col.replace('_', ' ').title(),
-                            format="$.2f"
-                        )
-                    
-                    # Display detailed purchase information
-                    st.subheader("Detailed Purchase Information")
-                    st.dataframe(
-                        purchase_details_df,
-                        column_config=column_config,
-                        use_container_width=True
+                # Create dynamic column config
+                column_config = {
+                    "purchase_date": "Date",
+                    "user_name": "User Name"
+                }
+                
+                # Automatically add number formatting for price-related columns
+                price_columns = [
+                    field.name for field in purchase_details.schema
+                    if is_price_column(field.name) and (pa.types.is_integer(field.type) or pa.types.is_floating(field.type))
+                ]
+                for col in price_columns:
+                    column_config[col] = st.column_config.NumberColumn(
+                        col.replace('_', ' ').title(),
+                        format="$.2f"
                     )
-                    
-                else:
-                    st.warning("No purchase data found for this user ID.")
-                    
-            except Exception as e:
-                st.error(f"Error executing query: {str(e)}")
+                
+                # Display detailed purchase information
+                st.subheader("Detailed Purchase Information")
+                st.dataframe(
+                    purchase_details,
+                    column_config=column_config,
+                    use_container_width=True
+                )
+                
+            else:
+                st.warning("No purchase data found for this user ID.")
+                
+        except Exception as e:
+            st.error(f"Error executing query: {str(e)}")
+
+def main():
+    st.title("Match Masters Analysis")
+
+    tab1, tab2 = st.tabs(["General Statistics", "Events"])
+
+    # Each tab is a fragment, so interacting with one doesn't rerun the other
+    with tab1:
+        render_stats_tab()
+
+    with tab2:
+        render_events_tab()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
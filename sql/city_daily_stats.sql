@@ -0,0 +1,26 @@
+-- Daily per-city rollup of EVENTS used by the General Statistics tab.
+-- Distinct users are kept as an HLL sketch per day and city, which can be
+-- combined over any date range without going back to the raw event stream.
+--
+-- CONTEXTS_IO_CANDIVORE_USER_BASE_STATS_1 is an array of user entities, as
+-- the Events tab reads it, so users come from FLATTEN. Materialized views
+-- can't use FLATTEN, hence a dynamic table. Each event's purchase is counted
+-- on its first entity only, so events with several entities count once.
+--
+-- Run with: snowsql -o variable_substitution=true -D warehouse=<name> -f ...
+CREATE OR REPLACE DYNAMIC TABLE CANDIVORE_TEST_DB.ATOMIC.CITY_DAILY_STATS
+    TARGET_LAG = '1 hour'
+    WAREHOUSE = &warehouse
+    CLUSTER BY (event_date, geo_city)
+AS
+SELECT
+    DATE(e.derived_tstamp) AS event_date,
+    e.GEO_CITY AS geo_city,
+    HLL_ACCUMULATE(f.value:uuid::string) AS users_sketch,
+    COUNT_IF(e.EVENT_NAME = 'in_app_purchase' AND f.index = 0) AS purchases
+FROM
+    CANDIVORE_TEST_DB.ATOMIC.EVENTS e,
+    LATERAL FLATTEN(input => e.CONTEXTS_IO_CANDIVORE_USER_BASE_STATS_1) f
+GROUP BY
+    DATE(e.derived_tstamp),
+    e.GEO_CITY;
@@ -0,0 +1,4 @@
+-- Cluster EVENTS on the columns the app filters by, so queries on a date
+-- range or on in_app_purchase events prune most micro-partitions.
+ALTER TABLE CANDIVORE_TEST_DB.ATOMIC.EVENTS
+    CLUSTER BY (DATE(derived_tstamp), EVENT_NAME);
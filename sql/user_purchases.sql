@@ -0,0 +1,26 @@
+-- In-app purchases keyed by user, used by the Events tab.
+-- The Events tab looks purchases up by user uuid, which otherwise means
+-- flattening the user contexts of every EVENTS row. Clustering this table on
+-- user_uuid lets those lookups prune down to the user's own micro-partitions.
+--
+-- CONTEXTS_IO_CANDIVORE_USER_BASE_STATS_1 is an array of user entities, so
+-- users come from FLATTEN, hence a dynamic table rather than a materialized
+-- view.
+--
+-- Run with: snowsql -o variable_substitution=true -D warehouse=<name> -f ...
+CREATE OR REPLACE DYNAMIC TABLE CANDIVORE_TEST_DB.ATOMIC.USER_PURCHASES
+    TARGET_LAG = '1 hour'
+    WAREHOUSE = &warehouse
+    CLUSTER BY (user_uuid)
+AS
+SELECT
+    f.value:uuid::string AS user_uuid,
+    f.value:user_name::string AS user_name,
+    e.derived_tstamp,
+    e.UNSTRUCT_EVENT_IO_CANDIVORE_IN_APP_PURCHASE_1 AS purchase_data
+FROM
+    CANDIVORE_TEST_DB.ATOMIC.EVENTS e,
+    LATERAL FLATTEN(input => e.CONTEXTS_IO_CANDIVORE_USER_BASE_STATS_1) f
+WHERE
+    e.EVENT_NAME = 'in_app_purchase'
+    AND e.UNSTRUCT_EVENT_IO_CANDIVORE_IN_APP_PURCHASE_1 IS NOT NULL;